@@ -4,18 +4,21 @@ import sys
 import json
 import time
 import gzip
-import io
 import threading
 from threading import Thread
 from typing import Dict, Tuple, IO
-from collections import defaultdict, OrderedDict
+from collections import deque
+from collections.abc import MutableMapping
 
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 from twisted.web import http
+from twisted.protocols.basic import FileSender
 
 from urllib.parse import urlparse, unquote, parse_qs
 import re
+from operator import itemgetter
 
 from . import crypto
 from .serializable import Serializable
@@ -23,6 +26,18 @@ from .serializable import Serializable
 
 from .logger import mplogger
 
+# zstandard is an optional dependency
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# orjson is an optional dependency
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 # https://twistedmatrix.com/documents/21.2.0/api/twisted.web.http.Request.html
 
 def path_join_safe(root_directory: str, filename: str):
@@ -51,7 +66,74 @@ def path_join_safe(root_directory: str, filename: str):
 
     return path
 
+def accepted_encodings(headers):
+    """ return the set of content codings the client will accept
+
+    :param headers: a CaseInsensitiveDict bytes=>List[bytes] of HTTP request headers
+    :returns: a set of lower case content codings, e.g. {b'gzip', b'zstd'}
+    """
+
+    encodings = set()
+    if headers is None:
+        return encodings
+
+    for value in headers.get(b'accept-encoding', None) or []:
+        for item in value.split(b","):
+            coding, *params = item.split(b";")
+            coding = coding.strip().lower()
+
+            quality = 1.0
+            for param in params:
+                name, _, qvalue = param.partition(b"=")
+                if name.strip().lower() == b"q":
+                    try:
+                        quality = float(qvalue)
+                    except ValueError:
+                        quality = 0.0
+
+            # a quality value of zero means 'not acceptable'
+            if coding and quality > 0:
+                encodings.add(coding)
+
+    return encodings
+
+def json_dumpb(obj):
+    """ serialize an object as compact JSON, returning bytes
+
+    orjson is used when it is installed, otherwise the standard library.
+    Both omit the spaces json.dumps writes after ',' and ':' by default.
+    Otherwise the output depends on whether orjson is installed: orjson
+    writes non-ASCII characters as UTF-8 instead of escaping them, writes
+    NaN and Infinity as null, and formats some floats differently.
+    Objects which orjson rejects, such as integers larger than 64 bits,
+    are encoded by the standard library instead.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(",", ":")).encode('utf-8')
+
+def _compress_payload(encoding, encoded):
+    """ private function
+
+    compress an encoded payload with the given content encoding.
+
+    This only uses its arguments, so it is safe to call from
+    a worker thread.
+    """
+    if encoding == 'zstd':
+        # compressors are not safe to share between threads
+        return zstandard.ZstdCompressor(level=3).compress(encoded)
+
+    # a fixed mtime keeps the output deterministic for a given payload
+    return gzip.compress(encoded, compresslevel=6, mtime=0)
+
 class Response(object):
+    # _payload and request are set by the TestClient
+    __slots__ = ('status_code', 'headers', 'payload', 'compress', '_payload', 'request')
+
     def __init__(self, payload=None, status_code=200, headers=None, compress=False):
         super(Response, self).__init__()
         self.status_code = status_code
@@ -66,21 +148,48 @@ class Response(object):
         """ return the payload in a form suitable for sending to the client
         """
 
+        encoded = self._encode(request)
+        encoding = None
         if self.compress:
-            # TODO: check if request headers suport compression
+            encoding = self._contentEncoding(request)
+            encoded = _compress_payload(encoding, encoded)
+
+        return self._finalize(encoded, encoding)
 
-            gzip_buffer = io.BytesIO()
-            gzip_file = gzip.GzipFile(mode='wb',
-                                      fileobj=gzip_buffer)
-            gzip_file.write(self.payload)
-            gzip_file.close()
+    def _encode(self, request):
+        """ return the payload serialized as bytes, before compression
 
-            self.payload = gzip_buffer.getvalue()
+        The payload may reference state owned by the reactor thread,
+        so this must be called from the reactor thread.
+        """
+        return self.payload
+
+    def _contentEncoding(self, request):
+        """ return the content encoding used to compress the payload
+
+        This reads the request headers, so it must be called from
+        the reactor thread.
+        """
+        if zstandard is not None and b'zstd' in accepted_encodings(request.headers):
+            return 'zstd'
+        return 'gzip'
 
+    def _setContentEncoding(self, encoding):
+        """ set the content encoding headers for a compressed payload
+        """
+        if encoding is not None:
+            self.headers['Content-Encoding'] = encoding
             self.headers['Vary'] = 'Accept-Encoding'
-            self.headers['Content-Encoding'] = 'gzip'
 
-        return self.payload
+    def _finalize(self, payload, encoding=None):
+        """ record the payload which will be sent to the client
+
+        :param encoding: the content encoding the payload was compressed with,
+            or None if it is not compressed
+        """
+        self._setContentEncoding(encoding)
+        self.payload = payload
+        return payload
 
     def __repr__(self):
         return "<%s(%d)>" % (self.__class__.__name__, self.status_code)
@@ -95,39 +204,81 @@ class ErrorResponse(Response):
     by urllib.
 
     """
+    __slots__ = ()
 
     def __init__(self, obj, status_code=400, headers=None):
         super(ErrorResponse, self).__init__(obj, status_code, headers)
 
 class JsonResponse(Response):
-    def __init__(self, obj, status_code=200, headers=None):
-        super(JsonResponse, self).__init__(obj, status_code, headers)
+    __slots__ = ()
 
-    def _get_payload(self, request):
-        """ return the payload in a form suitable for sending to the client
+    def __init__(self, obj, status_code=200, headers=None, compress=False):
+        super(JsonResponse, self).__init__(obj, status_code, headers, compress)
+
+    def _encode(self, request):
+        """ return the payload serialized as bytes, before compression
+        """
+        self.headers['Content-Type'] = "application/json"
+        return json_dumpb(self.payload) + b"\n"
+
+    def _finalize(self, payload, encoding=None):
+        """ record the payload which will be sent to the client
         """
+        self._setContentEncoding(encoding)
+        self.headers['Content-Length'] = str(len(payload))
+        return payload
 
-        # TODO: support compression (copy from above)
+class _StaticJsonResponse(JsonResponse):
+    """ private class
 
-        payload = super()._get_payload(request)
-        encoded = json.dumps(payload).encode('utf-8') + b"\n"
+    A JsonResponse for a payload which never changes. The payload is
+    encoded once, by _static_json, and shared by every response.
+    """
+    __slots__ = ('_encoded',)
+
+    def __init__(self, static, status_code):
+        obj, encoded = static
+        super(_StaticJsonResponse, self).__init__(obj, status_code)
+        self._encoded = encoded
+
+    def _encode(self, request):
+        """ return the payload serialized as bytes, before compression
+        """
         self.headers['Content-Type'] = "application/json"
-        self.headers['Content-Length'] = str(len(encoded))
-        return encoded
+        return self._encoded
+
+def _static_json(obj):
+    """ private function
+
+    encode a fixed payload for use with a _StaticJsonResponse
+    """
+    return obj, json_dumpb(obj) + b"\n"
+
+_ERROR_NOT_FOUND = _static_json({'error': 'path not found'})
+_ERROR_LENGTH_REQUIRED = _static_json({'error': 'Content-Length not specified'})
+_ERROR_TOO_LARGE = _static_json({'error': 'Payload too large'})
+_ERROR_NO_RESPONSE = _static_json({'error': 'route failed to return a response'})
+_ERROR_TOO_MANY_REQUESTS = _static_json({'error': 'Too Many Requests'})
+_ERROR_COMPRESS_FAILED = _static_json({'error': 'failed to compress response'})
 
 class SerializableResponse(Response):
-    def __init__(self, obj, status_code=200, headers=None):
-        super(SerializableResponse, self).__init__(obj, status_code, headers)
+    __slots__ = ()
 
-    def _get_payload(self, request):
-        """ return the payload in a form suitable for sending to the client
-        """
+    def __init__(self, obj, status_code=200, headers=None, compress=False):
+        super(SerializableResponse, self).__init__(obj, status_code, headers, compress)
 
-        payload = super()._get_payload(request)
-        encoded = payload.dumpb()
+    def _encode(self, request):
+        """ return the payload serialized as bytes, before compression
+        """
         self.headers['Content-Type'] = "application/x-serializable"
-        self.headers['Content-Length'] = str(len(encoded))
-        return encoded
+        return self.payload.dumpb()
+
+    def _finalize(self, payload, encoding=None):
+        """ record the payload which will be sent to the client
+        """
+        self._setContentEncoding(encoding)
+        self.headers['Content-Length'] = str(len(payload))
+        return payload
 
 def get(path):
     """decorator which registers a class method as a GET handler"""
@@ -202,43 +353,217 @@ def ratelimit(rate):
 
     return decorator
 
-class CacheDict(OrderedDict):
+class _CacheNode(object):
+    """ private class
+
+    a link in the CacheDict doubly linked list
+    """
+    __slots__ = ('prev', 'next', 'key', 'value')
+
+    def __init__(self, key=None, value=None):
+        self.prev = self
+        self.next = self
+        self.key = key
+        self.value = value
+
+class CacheDict(MutableMapping):
+    """ A dictionary which holds at most cache_len items
+
+    When the dictionary is full, inserting a new key removes the least
+    recently used key. Both getting and setting a key with [] marks it as
+    used. As with the OrderedDict this class used to be based on, get(),
+    membership tests and iteration do not change the order.
+
+    The keys are stored in a dict mapping to nodes in a circular doubly
+    linked list. The most recently used node is at the tail of the list.
+    """
 
     def __init__(self, *args, cache_len: int = 128, **kwargs):
         assert cache_len > 0
         self.cache_len = cache_len
 
-        super().__init__(*args, **kwargs)
+        self._map = {}
+        self._root = _CacheNode()
+
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    # the list operations are written inline in __getitem__ and __setitem__
+    # to avoid the method call overhead on the rate limiter hot path
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        super().move_to_end(key)
+        root = self._root
+        node = self._map.get(key, None)
+        if node is None:
+            node = _CacheNode(key, value)
+            self._map[key] = node
+
+            # a set adds at most one key, so at most one key is evicted
+            if len(self._map) > self.cache_len:
+                self.popitem(last=False)
+        else:
+            node.value = value
+            node.prev.next = node.next
+            node.next.prev = node.prev
 
-        while len(self) > self.cache_len:
-            oldkey = next(iter(self))
-            super().__delitem__(oldkey)
+        last = root.prev
+        last.next = node
+        node.prev = last
+        node.next = root
+        root.prev = node
 
     def __getitem__(self, key):
-        val = super().__getitem__(key)
-        super().move_to_end(key)
+        node = self._map[key]
+        root = self._root
+
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+        last = root.prev
+        last.next = node
+        node.prev = last
+        node.next = root
+        root.prev = node
+
+        return node.value
+
+    def __delitem__(self, key):
+        node = self._map.pop(key)
+        node.prev.next = node.next
+        node.next.prev = node.prev
 
-        return val
+    def popitem(self, last=True):
+        """ remove and return a (key, value) pair
+
+        :param last: if True remove the most recently used item,
+            otherwise remove the least recently used item.
+        """
+        if not self._map:
+            raise KeyError('dictionary is empty')
+
+        node = self._root.prev if last else self._root.next
+        del self[node.key]
+
+        return node.key, node.value
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def __iter__(self):
+        """ iterate over the keys, from least to most recently used """
+        node = self._root.next
+        while node is not self._root:
+            yield node.key
+            node = node.next
+
+    def get(self, key, default=None):
+        node = self._map.get(key, None)
+        if node is None:
+            return default
+        return node.value
+
+    def values(self):
+        """ return a list of the values, from least to most recently used """
+        return [value for _, value in self.items()]
+
+    def items(self):
+        """ return a list of (key, value) pairs, from least to most recently used """
+        items = []
+        node = self._root.next
+        while node is not self._root:
+            items.append((node.key, node.value))
+            node = node.next
+        return items
+
+    def clear(self):
+        self._map.clear()
+        self._root.prev = self._root
+        self._root.next = self._root
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.items())
+
+_MISSING = object()
 
 class CaseInsensitiveDict(dict):
+    """ A dictionary with case insensitive str or bytes keys
+
+    Keys are normalized to lower case when inserted, and str keys are
+    interned. A lookup first tries the key as given, so callers which
+    use lower case keys do not pay for normalizing the key.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
     def __setitem__(self, key, value):
-        super().__setitem__(key.upper(), value)
+        key = key.lower()
+        if isinstance(key, str):
+            key = sys.intern(key)
+        super().__setitem__(key, value)
 
     def __getitem__(self, key):
-        return super().__getitem__(key.upper())
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            value = super().__getitem__(key.lower())
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or super().__contains__(key.lower())
 
-    def __in__(self, key):
-        return super().__in__(key.upper())
+    def get(self, key, default=None):
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            value = super().get(key.lower(), default)
+        return value
+
+class _HeaderAdapter(object):
+    """ private class
+
+    A read only, case insensitive view of the twisted request headers.
+
+    Lookups are forwarded to the twisted Headers instance, which already
+    normalizes header names, so the headers are not copied for each request.
+    Like twisted, a str key returns str values and a bytes key returns
+    bytes values.
+    """
+    __slots__ = ('_headers',)
+
+    def __init__(self, headers):
+        self._headers = headers
+
+    def __getitem__(self, key):
+        values = self._headers.getRawHeaders(key)
+        if values is None:
+            raise KeyError(key)
+        return values
 
     def __contains__(self, key):
-        return super().__contains__(key.upper())
+        return self._headers.hasHeader(key)
+
+    def __iter__(self):
+        for key, _ in self._headers.getAllRawHeaders():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self._headers.getAllRawHeaders())
 
     def get(self, key, default=None):
-        return super().get(key.upper(), default)
+        return self._headers.getRawHeaders(key, default)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self._headers.getAllRawHeaders())
+
+    def __repr__(self):
+        return "<Headers %r>" % dict(self._headers.getAllRawHeaders())
 
 class OrderedPropertyMap(dict):
     # https://www.python.org/dev/peps/pep-3115/
@@ -275,13 +600,16 @@ class RollingCounter(object):
     """
 
     """
+    __slots__ = ('interval_ms', '_current_index', '_bins', '_counts', '_count')
+
     def __init__(self, interval_ms, bins=4):
         super(RollingCounter, self).__init__()
 
         self.interval_ms = interval_ms // bins
         self._current_index = 0
         self._bins = bins
-        self._counts = []
+        # a fixed length deque drops the oldest bin when a new bin is added
+        self._counts = deque([0] * bins, maxlen=bins)
         self._count = 0
 
     def increment(self):
@@ -300,15 +628,16 @@ class RollingCounter(object):
             # if more than one period elapsed since the last event
             # reset the counter completely
             if index - self._current_index > self._bins:
-                self._counts = [0]
+                self._counts = deque([0] * self._bins, maxlen=self._bins)
+                self._count = 0
             else:
+                # the running total no longer includes the dropped bin
+                self._count -= self._counts[0]
                 self._counts.append(0)
-                while len(self._counts) > self._bins:
-                    self._counts.pop(0)
                 self._current_index = index
 
         self._counts[-1] += 1
-        self._count =sum(self._counts)
+        self._count += 1
 
         return self._count
 
@@ -319,8 +648,8 @@ class RateLimiter(object):
     def __init__(self, limit, interval_ms, capacity):
         super(RateLimiter, self).__init__()
 
-        self.counter = CacheDict(capacity=capacity)
-        self.blocked = CacheDict(capacity=capacity)
+        self.counter = CacheDict(cache_len=capacity)
+        self.blocked = CacheDict(cache_len=capacity)
         self.limit = limit
         self.interval_ms = interval_ms
 
@@ -334,6 +663,8 @@ class RateLimiter(object):
         return count > self.limit
 
 class Route(object):
+    __slots__ = ('name', 'method', 'pattern', 'callback',
+        'ratelimit', 'options', 'max_content_length')
 
     def __init__(self, name, method, pattern, callback):
         super(Route, self).__init__()
@@ -344,6 +675,8 @@ class Route(object):
 
         self.ratelimit = None
         self.options = {}
+        # cached from options when the route is registered
+        self.max_content_length = None
 
 
     def __repr__(self):
@@ -432,7 +765,7 @@ def request_response(router, request):
     result = router.getRoute(request.method, request.path)
 
     if not result:
-        return JsonResponse({'error': 'path not found'}, 404)
+        return _StaticJsonResponse(_ERROR_NOT_FOUND, 404)
 
     endpt, matches = result
     request.matches = matches
@@ -441,24 +774,18 @@ def request_response(router, request):
 
     # check the put/post options and validate the incoming request.
     # ensure that the input is not too large
-    max_content_length = endpt.options.get('max_content_length', None)
+    max_content_length = endpt.max_content_length
     if max_content_length is not None:
-        request_content_length = 0
+        values = request.headers.get(b'content-length', None)
 
-        if b'Content-Length' not in request.headers:
-            response = JsonResponse({'error': 'Content-Length not specified'}, 411)
+        if values is None:
+            response = _StaticJsonResponse(_ERROR_LENGTH_REQUIRED, 411)
         else:
-            try:
-                request_content_length = int(request.headers[b'Content-Length'][0])
-                if request_content_length < 0:
-                    request_content_length = 0
-            except ValueError as e:
-                request_content_length = 0
-            except Exception as e:
-                request_content_length = 0
-
-        if request_content_length > max_content_length:
-            response = JsonResponse({'error': 'Payload too large'}, 413)
+            # a missing, negative or malformed length is treated as zero
+            request_content_length = int(values[0]) if values and values[0].isdigit() else 0
+
+            if request_content_length > max_content_length:
+                response = _StaticJsonResponse(_ERROR_TOO_LARGE, 413)
 
     # if the validations passed, run the user callback
     if response is None:
@@ -469,8 +796,7 @@ def request_response(router, request):
             response = None
 
     if response is None:
-        response = JsonResponse({'error':
-            'route failed to return a response'}, 500)
+        response = _StaticJsonResponse(_ERROR_NO_RESPONSE, 500)
 
     if not isinstance(response, Response):
         raise TypeError(type(response))
@@ -490,6 +816,9 @@ class Router(object):
             "POST": [],
             "PUT": [],
         }
+        # per method, a single regex combining every route pattern
+        # and a lookup table for finding the matched route
+        self.route_regex = {method: (None, {}) for method in self.route_table}
         self.routes = []
 
         # a rate limiter which limits requests per IP
@@ -511,23 +840,83 @@ class Router(object):
             regex, tokens = self.patternToRegex(route.pattern)
             if route.method not in self.route_table:
                 raise ValueError("Unsupported method: %s" % route.method)
+            route.max_content_length = route.options.get('max_content_length', None)
             self.route_table[route.method].append((regex, tokens, route))
             self.routes.append(route)
 
+        for method in self.route_table:
+            self._compileRouteTable(method)
+
+    def _compileRouteTable(self, method):
+        """ private method
+
+        combine all of the patterns for a given method into a single regex.
+
+        Each route pattern is wrapped in a capture group, the index of
+        that group identifies which route matched. The alternation preserves
+        registration order, so the first successful match is still used.
+
+        Each route is paired with a function, specialized for the
+        number of tokens in the pattern, which extracts the matches.
+        """
+
+        patterns = []
+        index = {}
+        group = 1
+        for regex, tokens, route in self.route_table[method]:
+            patterns.append("(%s)" % regex.pattern)
+            groups = tuple(range(group + 1, group + 1 + regex.groups))
+            index[group] = (route, self._matchExtractor(tokens, groups))
+            group += 1 + regex.groups
+
+        if patterns:
+            self.route_regex[method] = (re.compile("|".join(patterns)), index)
+        else:
+            self.route_regex[method] = (None, index)
+
+    def _matchExtractor(self, tokens, groups):
+        """ private method
+
+        returns a function which takes a regex match object and
+        returns a dictionary mapping each token to the matched value.
+
+        :param tokens: the token names for a route
+        :param groups: the index of the capture group for each token
+        """
+
+        if not tokens:
+            return lambda m: {}
+
+        if len(tokens) == 1:
+            token, = tokens
+            group, = groups
+            return lambda m: {token: m[group]}
+
+        tokens = tuple(tokens)
+        getter = itemgetter(*groups)
+        return lambda m: dict(zip(tokens, getter(m)))
+
     def getRoute(self, method, path):
         """ private method
 
         Get the route for a given method and path
         """
-        if method not in self.route_table:
+        if method not in self.route_regex:
             mplogger.error("unsupported method: %s", method)
             return None
 
-        for re_ptn, tokens, endpt in self.route_table[method]:
-            m = re_ptn.match(path)
-            if m:
-                return endpt, {k: v for k, v in zip(tokens, m.groups())}
-        return None
+        re_ptn, index = self.route_regex[method]
+        if re_ptn is None:
+            return None
+
+        m = re_ptn.match(path)
+        if not m:
+            return None
+
+        # the outer group for a route closes last, so lastindex
+        # identifies the route even when the route has tokens
+        endpt, extract = index[m.lastindex]
+        return endpt, extract(m)
 
     def patternToTemplate(self, pattern):
         """ private method
@@ -619,13 +1008,20 @@ class Router(object):
         re_str += '$'
         return (re.compile(re_str), tokens)
 
-    def dispatch(self, request):
+    def getResponse(self, request):
+        """ private method
+
+        Get the response for a request, without encoding the payload
+        """
 
-        response = None
         if self.limiter.insert(request.client_address[0]):
-            response = JsonResponse({'error': 'Too Many Requests'}, 429)
-        else:
-            response = request_response(self, request)
+            return _StaticJsonResponse(_ERROR_TOO_MANY_REQUESTS, 429)
+
+        return request_response(self, request)
+
+    def dispatch(self, request):
+
+        response = self.getResponse(request)
 
         # this may mutate the headers
         payload = response._get_payload(request)
@@ -638,7 +1034,12 @@ class TestClient(object):
 
         self.router = router
 
+        # the path template for each route, parsed once
+        self._templates = {}
+
         for route in router.routes:
+            self._templates[route] = router.patternToTemplate(route.pattern)
+
             name = route.name.replace(".", "_")
             fn = lambda *args, _route=route, **kwargs: self._call(_route, args, **kwargs)
 
@@ -676,7 +1077,7 @@ class TestClient(object):
         return bytesdict
 
     def _build_request(self, route, args, params=None, fragment=None, headers=None, body=None):
-        template, tokens, required = self.router.patternToTemplate(route.pattern)
+        template, tokens, required = self._templates[route]
 
         if len(args) < required:
             raise ValueError("expected %d positional arguments, found %d" % (
@@ -690,7 +1091,7 @@ class TestClient(object):
         if len(args) > len(tokens):
             path += "".join(["/%s" % s for s in args[len(tokens):]])
 
-        headers = self._coerce_dict(headers)
+        headers = CaseInsensitiveDict(self._coerce_dict(headers))
 
         req = Request(('127.0.0.1', 54321), route.method, path, params, fragment, headers, body)
         req.matches = {tok:arg for tok, arg in zip(tokens, args)}
@@ -719,20 +1120,22 @@ def parse_url(path):
 
     parsed = urlparse(path)
 
-    query = defaultdict(list)
-    parts = parsed.query.split(b"&")
-    for part in parts:
-        if part:
-            if b'=' in part:
-                name, value = part.split(b"=", 1)
-                name = unquote(name.decode("utf-8"))
-                value = unquote(value.decode("utf-8"))
-            else:
-                name = unquote(part.decode("utf-8"))
-                value = None
-            query[name].append(value)
+    # decode the query once, '&' and '=' never appear inside a
+    # multi-byte utf-8 sequence so splitting the decoded string is safe.
+    query = {}
+    if parsed.query:
+        for part in parsed.query.decode("utf-8").split("&"):
+            if part:
+                # a parameter without '=' has the value None
+                name, sep, value = part.partition("=")
+                name = unquote(name)
+                value = unquote(value) if sep else None
+                if name in query:
+                    query[name].append(value)
+                else:
+                    query[name] = [value]
 
-    return parsed.path, dict(query), parsed.fragment
+    return parsed.path, query, parsed.fragment
 
 class Request(object):
     """ A Request contains the information received from a client
@@ -747,6 +1150,8 @@ class Request(object):
     :attr stream: a File-like object containig the request content
     :attr matches: dictionary of matched path components. See the Resource documentation for more information
     """
+    __slots__ = ('client_address', 'method', 'path', 'params',
+        'fragment', 'headers', 'stream', 'matches')
 
     def __init__(self, addr: Tuple[str, int], method: str, path: str, params: Dict[str, str], fragment: str, headers: Dict[bytes, bytes], stream: IO[bytes]):
         """
@@ -785,7 +1190,10 @@ class Request(object):
         return "<Request %s %s>" % (self.method, self.path)
 
 class RequestFactory(http.Request):
-    BUFFER_TX_SIZE = 2048
+    BUFFER_TX_SIZE = 65536
+    # encoded payloads at least this large are compressed in a worker
+    # thread so that the reactor is not blocked.
+    COMPRESS_THREAD_SIZE = 65536
 
     def process(self):
         """ private method
@@ -796,11 +1204,6 @@ class RequestFactory(http.Request):
         router = self.channel.requestRouter
 
         addr = self.getClientAddress()
-
-        headers = CaseInsensitiveDict()
-        for key, value in self.requestHeaders.getAllRawHeaders():
-            headers[key] = value
-
         hostport = (addr.host, addr.port)
 
         path, query, fragment = parse_url(self.uri)
@@ -811,32 +1214,75 @@ class RequestFactory(http.Request):
                 path.decode("utf-8"),
                 query,
                 fragment,
-                headers,
+                _HeaderAdapter(self.requestHeaders),
                 self.content)
 
-        response, payload = router.dispatch(req)
+        response = router.getResponse(req)
+
+        # the payload returned by the handler may reference state owned
+        # by the reactor, so it is always encoded here, and the content
+        # encoding is chosen from the request headers here. A worker
+        # thread is only given the encoding and the encoded bytes.
+        # these may mutate the headers
+        encoded = response._encode(req)
+        encoding = response._contentEncoding(req) if response.compress else None
+
+        if self._compressInThread(response, encoded):
+            d = deferToThread(_compress_payload, encoding, encoded)
+            d.addCallbacks(
+                lambda payload: self._writeResponse(t0, req, response, response._finalize(payload, encoding)),
+                lambda failure: self._compressFailed(t0, req, failure))
+        else:
+            if encoding is not None:
+                encoded = _compress_payload(encoding, encoded)
+            self._writeResponse(t0, req, response, response._finalize(encoded, encoding))
+
+    def _compressInThread(self, response, encoded):
+        """ private method
+
+        returns true if the encoded payload should be compressed in a worker thread.
+        """
+        return response.compress and isinstance(encoded, bytes) and \
+            len(encoded) >= RequestFactory.COMPRESS_THREAD_SIZE
+
+    def _compressFailed(self, t0, req, failure):
+        """ private method
+
+        send an error to the client if the payload could not be compressed
+        """
+        mplogger.error("failed to compress response: %s", failure.getTraceback())
+        response = _StaticJsonResponse(_ERROR_COMPRESS_FAILED, 500)
+        self._writeResponse(t0, req, response, response._get_payload(req))
+
+    def _writeResponse(self, t0, req, response, payload):
+        """ private method
+
+        write the response headers and payload to the client
+        """
+
+        streaming = False
 
-        content_length = None
+        # the responses in this module always use this spelling. For any
+        # other spelling the length is computed below, and twisted headers
+        # are case insensitive so the computed value replaces the original.
+        headers = response.headers
+        content_length = headers.get("Content-Length", None)
+        if content_length is None:
+            content_length = headers.get("content-length", None)
 
         try:
 
             self.setResponseCode(response.status_code)
 
-            for k, v in response.headers.items():
-                if k.lower() == "content-length":
-                    content_length = v
+            for k, v in headers.items():
                 if not isinstance(v, str):
                     mplogger.warning("header value is not a string. %s=%s", k, v)
                     v = str(v)
                 self.setHeader(k, v)
 
             if hasattr(payload, "read"):
-                content_length = 0
-                buf = payload.read(RequestFactory.BUFFER_TX_SIZE)
-                while buf:
-                    self.write(buf)
-                    content_length += len(buf)
-                    buf = payload.read(RequestFactory.BUFFER_TX_SIZE)
+                self._sendFile(t0, req, response, payload)
+                streaming = True
             else:
                 if content_length is None:
                     # content length has not been set
@@ -845,26 +1291,74 @@ class RequestFactory(http.Request):
                 self.write(payload)
 
         except ConnectionAbortedError as e:
-            sys.stderr.write("%s aborted\n" % url.path)
+            sys.stderr.write("%s aborted\n" % req.path)
         except BrokenPipeError as e:
-            sys.stderr.write("%s aborted\n" % url.path)
+            sys.stderr.write("%s aborted\n" % req.path)
         finally:
-            if hasattr(payload, "close"):
-                payload.close()
-
-            elapsed = int((time.perf_counter() - t0) * 1000)
-            mplogger.info("%016X %s:%s %s %3s t=%6d %-8s %s [%s] %s" % (
-                threading.get_ident(),
-                self.getClientAddress().host,
-                self.getClientAddress().port,
-                self.clientproto.decode(),
-                response.status_code,
-                elapsed,
-                req.method,
-                req.path,
-                content_length,
-                "z" if response.compress else ""))
+            # a streamed payload finishes the request once the transfer completes
+            if not streaming:
+                self._finishResponse(t0, req, response, payload, content_length)
+
+    def _sendFile(self, t0, req, response, payload):
+        """ private method
+
+        stream a file like payload to the client.
+
+        The payload is read by a producer as the transport is ready to
+        accept more data, instead of being written in a single loop.
+        """
 
+        sent = [0]
+        def count(buf):
+            sent[0] += len(buf)
+            return buf
+
+        # when the transport is lost the sender fails before the request
+        # is told the connection was lost, so track the loss separately.
+        lost = []
+        self.notifyFinish().addErrback(lost.append)
+
+        sender = FileSender()
+        sender.CHUNK_SIZE = RequestFactory.BUFFER_TX_SIZE
+        d = sender.beginFileTransfer(payload, self, count)
+
+        def done(result):
+            self._finishResponse(t0, req, response, payload, sent[0], not lost)
+
+        def failed(failure):
+            # the transfer was stopped, the request can not be finished
+            sys.stderr.write("%s aborted\n" % req.path)
+            if self.producer is not None:
+                self.unregisterProducer()
+            self._finishResponse(t0, req, response, payload, sent[0], False)
+
+        d.addCallbacks(done, failed)
+
+    def _finishResponse(self, t0, req, response, payload, content_length, finish=True):
+        """ private method
+
+        release the payload, log the request and finish the response
+
+        :param finish: if false, the response is not finished because
+            the connection to the client was lost.
+        """
+        if hasattr(payload, "close"):
+            payload.close()
+
+        elapsed = int((time.perf_counter() - t0) * 1000)
+        mplogger.info("%016X %s:%s %s %3s t=%6d %-8s %s [%s] %s" % (
+            threading.get_ident(),
+            req.client_address[0],
+            req.client_address[1],
+            self.clientproto.decode(),
+            response.status_code,
+            elapsed,
+            req.method,
+            req.path,
+            content_length,
+            "z" if response.compress else ""))
+
+        if finish and not self._disconnected:
             self.finish()
 
 class HTTPFactory(http.HTTPFactory):
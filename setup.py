@@ -32,6 +32,16 @@ install_requires=[
   'service-identity>=21.1.0',
 ]
 
+# optional packages used by the http server when they are installed
+# orjson: faster JSON encoding for JsonResponse
+# zstandard: zstd compression for clients which accept it
+extras_require={
+  'http': [
+    'orjson>=3.0',
+    'zstandard>=0.15',
+  ],
+}
+
 version = "0.2.1"
 url = 'https://github.com/nsetzer/mpgameserver'
 download_url = "%s/archive/%s.tar.gz" % (url, version)
@@ -53,5 +63,6 @@ setup(name=packge_name,
       keywords=keywords,
       classifiers=classifiers,
       install_requires=install_requires,
+      extras_require=extras_require,
       entry_points=entry_points
      )
\ No newline at end of file
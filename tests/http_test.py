@@ -2,12 +2,32 @@
 import unittest
 
 import io
+import gzip
+import json
+from unittest import mock
 
 from mpgameserver import Serializable, HTTPServer, Router, Resource, \
     get, put, post, delete, \
     Response, JsonResponse, SerializableResponse
 
-from mpgameserver.http_server import Request, TestClient
+from mpgameserver.http_server import Request, TestClient, accepted_encodings, \
+    CacheDict, CaseInsensitiveDict, RateLimiter, RollingCounter, parse_url, \
+    json_dumpb, _HeaderAdapter
+
+from mpgameserver.http_server import RequestFactory
+
+from twisted.web.http_headers import Headers
+from twisted.web.test.requesthelper import DummyChannel
+from twisted.internet.address import IPv4Address
+from twisted.internet.error import ConnectionLost
+from twisted.python.failure import Failure
+from twisted.internet import defer
+
+# zstandard is an optional dependency
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class SampleResource(Resource):
@@ -49,6 +69,22 @@ class SampleResource(Resource):
         #print("params", request.params)
         return JsonResponse({}, status_code=200)
 
+    @put("/small", max_content_length=4)
+    def put_small(self, request):
+        return JsonResponse({}, status_code=200)
+
+    @get("/compress")
+    def get_compress(self, request):
+        return Response(b"abc" * 1024, compress=True)
+
+    @get("/json/compress")
+    def get_json_compress(self, request):
+        return JsonResponse({"abc": [1, 2, 3]}, compress=True)
+
+    @get("/json/matches")
+    def get_json_matches(self, request):
+        return JsonResponse({"matches": request.matches})
+
 class HttpServerTestCase(unittest.TestCase):
 
     @classmethod
@@ -85,6 +121,28 @@ class HttpServerTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.request.path, "/simple")
 
+    def test_max_content_length(self):
+
+        response = self.client.sample_put_small(headers={"Content-Length": 4}, body=io.BytesIO())
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.sample_put_small(headers={"content-length": 5}, body=io.BytesIO())
+        self.assertEqual(response.status_code, 413)
+
+        response = self.client.sample_put_small(headers={"Content-Length": "abc"}, body=io.BytesIO())
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.sample_put_small(body=io.BytesIO())
+        self.assertEqual(response.status_code, 411)
+
+    def test_not_found(self):
+        request = Request(('127.0.0.1', 54321), "GET", "/missing", {}, "", {}, None)
+        response, payload = self.router.dispatch(request)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(payload), {'error': 'path not found'})
+        self.assertEqual(response.headers['Content-Length'], str(len(payload)))
+
     def test_optone(self):
 
         response = self.client.sample_get_path_optone()
@@ -120,6 +178,457 @@ class HttpServerTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.request.path, "/params")
 
+    def test_compress(self):
+        response = self.client.sample_get_compress()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.payload), b"abc" * 1024)
+
+    def test_json(self):
+        response = self.client.sample_get_simple()
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(response.payload, b"{}\n")
+        self.assertEqual(response.headers['Content-Length'], "3")
+
+    def test_json_compress(self):
+        response = self.client.sample_get_json_compress()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Content-Length'], str(len(response.payload)))
+        payload = json.loads(gzip.decompress(response.payload))
+        self.assertEqual(payload, {"abc": [1, 2, 3]})
+
+    def test_json_matches(self):
+        response = self.client.sample_get_json_matches()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.payload), {"matches": {}})
+
+    def test_json_dumpb(self):
+        self.assertEqual(json.loads(json_dumpb({"a": [1, "b"]})), {"a": [1, "b"]})
+        # integers outside the 64 bit range are still supported
+        self.assertEqual(json.loads(json_dumpb({"a": 2**70})), {"a": 2**70})
+        # a lone surrogate can only be written escaped
+        self.assertEqual(json.loads(json_dumpb({"a": "\ud800"})), {"a": "\ud800"})
+
+    @unittest.skipIf(zstandard is None, "zstandard not installed")
+    def test_compress_zstd(self):
+        headers = {"Accept-Encoding": "gzip, zstd"}
+        response = self.client.sample_get_compress(headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'zstd')
+        payload = zstandard.ZstdDecompressor().decompress(response.payload)
+        self.assertEqual(payload, b"abc" * 1024)
+
+        headers = {"Accept-Encoding": "gzip, zstd;q=0"}
+        response = self.client.sample_get_compress(headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings({}), set())
+        headers = CaseInsensitiveDict({b'Accept-Encoding': [b'gzip, deflate;q=0.5', b'ZSTD, br; q=0']})
+        self.assertEqual(accepted_encodings(headers), {b'gzip', b'deflate', b'zstd'})
+
+class RouterTestCase(unittest.TestCase):
+
+    def test_get_route(self):
+
+        router = Router()
+        router.registerRoutes(SampleResource())
+
+        endpt, matches = router.getRoute("GET", "/simple")
+        self.assertEqual(endpt.name, "sample.get_simple")
+        self.assertEqual(matches, {})
+        # each request gets its own dictionary
+        matches["abc"] = 1
+        endpt, matches = router.getRoute("GET", "/simple")
+        self.assertEqual(matches, {})
+
+        endpt, matches = router.getRoute("GET", "/path/optone")
+        self.assertEqual(endpt.name, "sample.get_path_optone")
+        self.assertEqual(matches, {"arg1": None})
+
+        endpt, matches = router.getRoute("GET", "/path/optplus/1/2")
+        self.assertEqual(endpt.name, "sample.get_path_optplus")
+        self.assertEqual(matches, {"arg1": "1/2"})
+
+        endpt, matches = router.getRoute("GET", "/path/optmany/1/2")
+        self.assertEqual(endpt.name, "sample.get_path_optmany")
+        self.assertEqual(matches, {"arg1": "1/2"})
+
+        endpt, matches = router.getRoute("DELETE", "/simple")
+        self.assertEqual(endpt.name, "sample.delete_simple")
+
+        self.assertIsNone(router.getRoute("GET", "/missing"))
+        self.assertIsNone(router.getRoute("PATCH", "/simple"))
+
+    def test_get_route_order(self):
+
+        class OrderResource(Resource):
+
+            @get("/user/:username")
+            def get_user(self, request):
+                return JsonResponse({})
+
+            @get("/user/:username/:item")
+            def get_item(self, request):
+                return JsonResponse({})
+
+            @get("/:any*")
+            def get_any(self, request):
+                return JsonResponse({})
+
+            @get("/user/admin")
+            def get_admin(self, request):
+                return JsonResponse({})
+
+        router = Router()
+        self.assertIsNone(router.getRoute("GET", "/user/bob"))
+        router.registerRoutes(OrderResource())
+
+        endpt, matches = router.getRoute("GET", "/user/bob")
+        self.assertEqual(endpt.name, "order.get_user")
+        self.assertEqual(matches, {"username": "bob"})
+
+        endpt, matches = router.getRoute("GET", "/user/bob/hat")
+        self.assertEqual(endpt.name, "order.get_item")
+        self.assertEqual(matches, {"username": "bob", "item": "hat"})
+
+        # the first successful match is used
+        endpt, matches = router.getRoute("GET", "/user/admin")
+        self.assertEqual(endpt.name, "order.get_user")
+
+        endpt, matches = router.getRoute("GET", "/other/path")
+        self.assertEqual(endpt.name, "order.get_any")
+        self.assertEqual(matches, {"any": "other/path"})
+
+class ParseUrlTestCase(unittest.TestCase):
+
+    def test_parse_url(self):
+
+        path, query, fragment = parse_url(b"/abc")
+        self.assertEqual(path, b"/abc")
+        self.assertEqual(query, {})
+        self.assertEqual(fragment, b"")
+
+        path, query, fragment = parse_url(b"/abc?a=1&b&c=&a=%202&&d=%E2%9C%93#top")
+        self.assertEqual(path, b"/abc")
+        self.assertEqual(query, {"a": ["1", " 2"], "b": [None], "c": [""], "d": ["\u2713"]})
+        self.assertEqual(fragment, b"top")
+
+class CaseInsensitiveDictTestCase(unittest.TestCase):
+
+    def test_keys(self):
+
+        headers = CaseInsensitiveDict({b'Content-Type': [b'text/plain']})
+        headers[b'CONTENT-LENGTH'] = [b'0']
+
+        self.assertEqual(headers[b'content-length'], [b'0'])
+        self.assertEqual(headers[b'Content-Length'], [b'0'])
+        self.assertEqual(headers.get(b'content-TYPE'), [b'text/plain'])
+        self.assertEqual(headers.get(b'Accept', 1), 1)
+        self.assertTrue(b'Content-Type' in headers)
+        self.assertFalse(b'Accept' in headers)
+        self.assertEqual(sorted(headers), [b'content-length', b'content-type'])
+
+        with self.assertRaises(KeyError):
+            headers[b'Accept']
+
+        headers = CaseInsensitiveDict()
+        headers['X-Name'] = 'abc'
+        self.assertEqual(headers['x-name'], 'abc')
+
+class HeaderAdapterTestCase(unittest.TestCase):
+
+    def test_headers(self):
+
+        raw = Headers()
+        raw.addRawHeader(b'Content-Length', b'0')
+        raw.addRawHeader(b'Accept-Encoding', b'gzip')
+        headers = _HeaderAdapter(raw)
+
+        self.assertEqual(headers[b'content-length'], [b'0'])
+        self.assertEqual(headers[b'Content-Length'], [b'0'])
+        self.assertEqual(headers['content-length'], ['0'])
+        self.assertEqual(headers.get(b'Accept', 1), 1)
+        self.assertTrue(b'CONTENT-LENGTH' in headers)
+        self.assertFalse(b'Accept' in headers)
+        self.assertEqual(len(headers), 2)
+        self.assertEqual(accepted_encodings(headers), {b'gzip'})
+
+        with self.assertRaises(KeyError):
+            headers[b'Accept']
+
+class CacheDictTestCase(unittest.TestCase):
+
+    def test_evict(self):
+
+        cache = CacheDict(cache_len=3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(list(cache), ['a', 'b', 'c'])
+
+        # inserting a new key removes the oldest
+        cache['d'] = 4
+        self.assertEqual(len(cache), 3)
+        self.assertFalse('a' in cache)
+        self.assertEqual(list(cache), ['b', 'c', 'd'])
+
+    def test_access_order(self):
+
+        cache = CacheDict(cache_len=3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+
+        # reading or updating a key marks it as recently used
+        self.assertEqual(cache['a'], 1)
+        cache['b'] = 5
+        self.assertEqual(list(cache), ['c', 'a', 'b'])
+
+        cache['d'] = 4
+        self.assertEqual(list(cache), ['a', 'b', 'd'])
+
+        # get and membership tests do not change the order
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c', 0), 0)
+        self.assertTrue('a' in cache)
+        self.assertEqual(list(cache), ['a', 'b', 'd'])
+
+        del cache['b']
+        self.assertEqual(list(cache), ['a', 'd'])
+        with self.assertRaises(KeyError):
+            cache['b']
+
+    def test_mapping(self):
+
+        cache = CacheDict({'a': 1, 'b': 2}, cache_len=3)
+        cache['c'] = 3
+
+        self.assertEqual(list(cache.keys()), ['a', 'b', 'c'])
+        self.assertEqual(cache.values(), [1, 2, 3])
+        self.assertEqual(cache.items(), [('a', 1), ('b', 2), ('c', 3)])
+        self.assertEqual(cache, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(repr(cache), "CacheDict([('a', 1), ('b', 2), ('c', 3)])")
+
+        self.assertEqual(cache.pop('b'), 2)
+        cache.update({'d': 4})
+        self.assertEqual(cache.setdefault('d', 0), 4)
+        self.assertEqual(cache.items(), [('a', 1), ('c', 3), ('d', 4)])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(list(cache), [])
+        cache['e'] = 5
+        self.assertEqual(cache.items(), [('e', 5)])
+
+    def test_popitem(self):
+
+        cache = CacheDict(cache_len=3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+
+        self.assertEqual(cache.popitem(), ('c', 3))
+        self.assertEqual(cache.popitem(last=False), ('a', 1))
+        self.assertEqual(cache.popitem(), ('b', 2))
+        with self.assertRaises(KeyError):
+            cache.popitem()
+
+class RollingCounterTestCase(unittest.TestCase):
+
+    def test_increment(self):
+
+        counter = RollingCounter(1000, bins=4)
+
+        with mock.patch("time.time") as time_mock:
+
+            time_mock.return_value = 0.0
+            self.assertEqual(counter.increment(), 1)
+            self.assertEqual(counter.increment(), 2)
+
+            # events in the next bins are accumulated
+            time_mock.return_value = 0.250
+            self.assertEqual(counter.increment(), 3)
+            time_mock.return_value = 0.500
+            self.assertEqual(counter.increment(), 4)
+            time_mock.return_value = 0.750
+            self.assertEqual(counter.increment(), 5)
+
+            # the oldest bin is dropped once there are more than 4 bins
+            time_mock.return_value = 1.000
+            self.assertEqual(counter.increment(), 4)
+            self.assertEqual(counter.value(), 4)
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_capacity(self):
+
+        limiter = RateLimiter(2, 60*1000, 4)
+        self.assertEqual(limiter.counter.cache_len, 4)
+        self.assertEqual(len(limiter.counter), 0)
+
+        for i in range(8):
+            limiter.insert("127.0.0.%d" % i)
+        self.assertEqual(len(limiter.counter), 4)
+
+class StreamResource(Resource):
+
+    def __init__(self):
+        super().__init__()
+        self.payload = None
+
+    @get("/file")
+    def get_file(self, request):
+        self.payload = io.BytesIO(b"abc" * 100000)
+        return Response(self.payload)
+
+class CompressResource(Resource):
+
+    def __init__(self):
+        super().__init__()
+        self.state = {"value": "abc" * 100000}
+
+    @get("/small")
+    def get_small(self, request):
+        return JsonResponse({"value": "abc"}, compress=True)
+
+    @get("/large")
+    def get_large(self, request):
+        return JsonResponse(self.state, compress=True)
+
+class RequestFactoryTestCase(unittest.TestCase):
+
+    def _request(self, router, path):
+        """ process a GET request using a channel which does not pull
+        from registered producers, so the test controls the transfer.
+        """
+        channel = DummyChannel()
+        channel.requestRouter = router
+
+        request = RequestFactory(channel)
+        request.method = b"GET"
+        request.uri = path
+        request.path = path
+        request.clientproto = b"HTTP/1.1"
+        request.content = io.BytesIO()
+        request.client = IPv4Address("TCP", "127.0.0.1", 54321)
+        request.process()
+
+        return channel, request
+
+    def test_stream(self):
+
+        resource = StreamResource()
+        router = Router()
+        router.registerRoutes(resource)
+
+        channel, request = self._request(router, b"/file")
+        self.assertFalse(request.finished)
+
+        producer, streaming = channel.transport.producers[-1]
+        while request.producer is not None:
+            producer.resumeProducing()
+
+        self.assertTrue(request.finished)
+        self.assertTrue(resource.payload.closed)
+        # decode the chunked response body
+        data = channel.transport.written.getvalue()
+        head, _, data = data.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        body = b""
+        while True:
+            size, _, data = data.partition(b"\r\n")
+            size = int(size, 16)
+            if size == 0:
+                break
+            body += data[:size]
+            data = data[size + 2:]
+        self.assertEqual(body, b"abc" * 100000)
+
+    def test_stream_aborted(self):
+
+        resource = StreamResource()
+        router = Router()
+        router.registerRoutes(resource)
+
+        channel, request = self._request(router, b"/file")
+
+        producer, streaming = channel.transport.producers[-1]
+        producer.resumeProducing()
+
+        # when the transport is lost the producer is stopped before
+        # the request is told that the connection was lost
+        producer.stopProducing()
+        request.connectionLost(Failure(ConnectionLost()))
+
+        self.assertFalse(request.finished)
+        self.assertIsNone(request.producer)
+        self.assertTrue(resource.payload.closed)
+
+    def _body(self, channel):
+        data = channel.transport.written.getvalue()
+        head, _, body = data.partition(b"\r\n\r\n")
+        return head, body
+
+    def test_compress_small(self):
+
+        router = Router()
+        router.registerRoutes(CompressResource())
+
+        with mock.patch("mpgameserver.http_server.deferToThread") as thread_mock:
+            channel, request = self._request(router, b"/small")
+            thread_mock.assert_not_called()
+
+        self.assertTrue(request.finished)
+        head, body = self._body(channel)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        self.assertEqual(json.loads(gzip.decompress(body)), {"value": "abc"})
+
+    def test_compress_large(self):
+
+        resource = CompressResource()
+        router = Router()
+        router.registerRoutes(resource)
+
+        with mock.patch("mpgameserver.http_server.deferToThread") as thread_mock:
+            d = defer.Deferred()
+            thread_mock.return_value = d
+            channel, request = self._request(router, b"/large")
+
+            # the payload is encoded before the worker thread is used
+            self.assertEqual(thread_mock.call_count, 1)
+            func, encoding, encoded = thread_mock.call_args[0]
+            self.assertEqual(encoding, "gzip")
+            self.assertEqual(encoded, json.dumps(resource.state).replace(" ", "").encode("utf-8") + b"\n")
+            self.assertFalse(request.finished)
+
+            # modifying the state does not change the response
+            resource.state["value"] = None
+            d.callback(func(encoding, encoded))
+
+        self.assertTrue(request.finished)
+        head, body = self._body(channel)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        self.assertEqual(json.loads(gzip.decompress(body)), {"value": "abc" * 100000})
+
+    def test_compress_failed(self):
+
+        router = Router()
+        router.registerRoutes(CompressResource())
+
+        with mock.patch("mpgameserver.http_server.deferToThread") as thread_mock, \
+                mock.patch("mpgameserver.http_server._compress_payload") as compress_mock:
+            thread_mock.side_effect = defer.maybeDeferred
+            compress_mock.side_effect = MemoryError()
+            channel, request = self._request(router, b"/large")
+            self.assertEqual(thread_mock.call_count, 1)
+
+        self.assertTrue(request.finished)
+        head, body = self._body(channel)
+        self.assertTrue(head.startswith(b"HTTP/1.1 500"))
+        self.assertEqual(json.loads(body), {"error": "failed to compress response"})
+
 def main():
     unittest.main()
 